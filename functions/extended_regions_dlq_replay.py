@@ -0,0 +1,356 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Lambda to replay lifecycle events parked in the dead letter queue
+'''
+
+import json
+import logging
+import os
+import boto3
+from botocore.exceptions import ClientError
+from extended_regions_lce_lambda import CFT, ENDPOINT_URL, \
+    add_stack_instance, get_new_account_id, get_param_value, \
+    get_stack_operation_status
+from extended_regions_mappings import get_baseline_mappings
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+SQS = boto3.client('sqs', endpoint_url=ENDPOINT_URL)
+LAMBDA = boto3.client('lambda', endpoint_url=ENDPOINT_URL)
+
+BATCH_SIZE = 10
+VISIBILITY_TIMEOUT = 900
+# get_stack_operation_status polls up to 25 times, 30 sec apart
+OPERATION_WAIT_MS = (25 * 30 + 60) * 1000
+MAX_INVOCATIONS = 100
+TIMEOUT_REASON = 'Lambda is about to time out'
+
+
+def receive_messages(queue_url, batch_size=BATCH_SIZE):
+    '''Return the next batch of messages from the queue, None on error'''
+
+    result = None
+
+    try:
+        result = SQS.receive_message(QueueUrl=queue_url,
+                                     MaxNumberOfMessages=batch_size,
+                                     VisibilityTimeout=VISIBILITY_TIMEOUT,
+                                     WaitTimeSeconds=1).get('Messages', [])
+    except Exception as exe:
+        LOGGER.error('Unable to receive messages: %s', str(exe))
+
+    return result
+
+
+def delete_messages(queue_url, receipt_handles):
+    '''Delete the given messages, return the handles that were not deleted'''
+
+    result = list()
+
+    for index in range(0, len(receipt_handles), BATCH_SIZE):
+        handles = receipt_handles[index:index + BATCH_SIZE]
+        entries = list()
+        for count, handle in enumerate(handles):
+            entries.append({'Id': str(count), 'ReceiptHandle': handle})
+        try:
+            output = SQS.delete_message_batch(QueueUrl=queue_url,
+                                              Entries=entries)
+            for item in output.get('Failed', []):
+                LOGGER.error('Unable to delete message: %s', item)
+                result.append(handles[int(item['Id'])])
+        except Exception as exe:
+            LOGGER.error('Unable to delete messages: %s', str(exe))
+            result += handles
+
+    return result
+
+
+def release_messages(queue_url, receipt_handles):
+    '''Make the given messages visible again for the next replay'''
+
+    for index in range(0, len(receipt_handles), BATCH_SIZE):
+        entries = list()
+        for count, handle in enumerate(
+                receipt_handles[index:index + BATCH_SIZE]):
+            entries.append({'Id': str(count), 'ReceiptHandle': handle,
+                            'VisibilityTimeout': 0})
+        try:
+            SQS.change_message_visibility_batch(QueueUrl=queue_url,
+                                                Entries=entries)
+        except Exception as exe:
+            LOGGER.error('Unable to release messages: %s', str(exe))
+
+
+def get_account_messages(messages):
+    '''Return receipt handles per account id, without an account id
+    and for messages that could not be parsed'''
+
+    accounts = dict()
+    skipped = list()
+    unparseable = list()
+
+    for message in messages:
+        try:
+            account_id = get_new_account_id(message['Body'])
+        except (TypeError, ValueError, KeyError) as exe:
+            LOGGER.error('Unable to parse message %s, leaving it in queue: %s',
+                         message['MessageId'], str(exe))
+            unparseable.append(message['ReceiptHandle'])
+            continue
+
+        if account_id:
+            accounts.setdefault(account_id, list()).append(
+                message['ReceiptHandle'])
+        else:
+            skipped.append(message['ReceiptHandle'])
+
+    return accounts, skipped, unparseable
+
+
+def list_deployed_regions(ss_name):
+    '''Return stack instance status per region, per account, None on error'''
+
+    result = dict()
+
+    try:
+        cft_paginator = CFT.get_paginator('list_stack_instances')
+        for page in cft_paginator.paginate(StackSetName=ss_name):
+            for item in page['Summaries']:
+                result.setdefault(item['Account'], dict())[
+                    item['Region']] = item['Status']
+    except Exception as exe:
+        LOGGER.error('Unable to list stack instances: %s', str(exe))
+        result = None
+
+    return result
+
+
+def group_missing_regions(accounts, regions, deployed):
+    '''Group accounts by the regions to create or update instances in
+
+    Only CURRENT instances count as deployed. OUTDATED or INOPERABLE
+    instances left behind by a failed operation are updated instead.
+    '''
+
+    result = dict()
+
+    for account in accounts:
+        instances = deployed.get(account, dict())
+        create = tuple(region for region in regions
+                       if region not in instances)
+        update = tuple(region for region in regions
+                       if instances.get(region, 'CURRENT') != 'CURRENT')
+        if create:
+            result.setdefault(('create', create), list()).append(account)
+        if update:
+            result.setdefault(('update', update), list()).append(account)
+        if not create and not update:
+            LOGGER.info('Account %s already deployed in all regions', account)
+
+    return result
+
+
+def update_stack_instance(ss_name, accounts, regions):
+    ''' Updates StackSet Instances '''
+
+    result = {'OperationId': None}
+    ops = {
+        'MaxConcurrentPercentage': 100,
+        'FailureTolerancePercentage': 20
+        }
+
+    try:
+        LOGGER.info('Update Stack Set Instances: %s, %s, %s',
+                    ss_name, regions, accounts)
+        result = CFT.update_stack_instances(StackSetName=ss_name,
+                                            Accounts=accounts,
+                                            Regions=regions,
+                                            OperationPreferences=ops)
+    except ClientError as exe:
+        LOGGER.error("Unexpected error: %s", str(exe))
+
+    return result['OperationId']
+
+
+def is_out_of_time(context):
+    '''Return True if a StackSet operation may not finish in time'''
+
+    return context is not None and \
+        context.get_remaining_time_in_millis() < OPERATION_WAIT_MS
+
+
+def replay_accounts(accounts, targets, deployed, context=None):
+    '''Deploy missing stack instances, return failed and pending accounts'''
+
+    failed = set()
+    pending = dict()
+
+    for item in targets:
+        groups = group_missing_regions(accounts, item['Regions'],
+                                       deployed[item['Target']])
+        pending[item['Target']] = list(groups.items())
+
+    # Operations on one StackSet run one at a time, so start one operation
+    # per StackSet on each round and wait for all of them together.
+    while any(pending.values()):
+        if is_out_of_time(context):
+            LOGGER.warning('Not enough time left for another operation')
+            break
+
+        operations = list()
+        for target, groups in pending.items():
+            if groups:
+                (action, regions), group = groups.pop(0)
+                if action == 'create':
+                    operation_id = add_stack_instance(target, group,
+                                                      list(regions))
+                else:
+                    operation_id = update_stack_instance(target, group,
+                                                         list(regions))
+                operations.append((target, operation_id, regions, group))
+
+        for target, operation_id, regions, group in operations:
+            if get_stack_operation_status(target, operation_id):
+                for account in group:
+                    instances = deployed[target].setdefault(account, dict())
+                    for region in regions:
+                        instances[region] = 'CURRENT'
+            else:
+                LOGGER.error('Replay failed on %s for %s', target, group)
+                failed.update(group)
+
+    left = set()
+    for groups in pending.values():
+        for _, group in groups:
+            left.update(group)
+
+    return failed, left - failed
+
+
+def replay_dead_letter_queue(queue_url, targets, context=None):
+    '''Drain the queue in batches and deploy the accounts it holds
+
+    All counters are in messages. Drained is True once the queue returned
+    no more messages, otherwise StopReason tells why the replay stopped.
+    '''
+
+    result = {'Replayed': 0, 'Skipped': 0, 'Failed': 0,
+              'Unparseable': 0, 'Pending': 0,
+              'Drained': False, 'StopReason': None}
+    deployed = dict()
+
+    for item in targets:
+        deployed[item['Target']] = list_deployed_regions(item['Target'])
+        if deployed[item['Target']] is None:
+            result['StopReason'] = 'Unable to list stack instances of ' + \
+                item['Target']
+            LOGGER.error('Stopped replay: %s', result['StopReason'])
+            return result
+
+    while True:
+        if is_out_of_time(context):
+            result['StopReason'] = TIMEOUT_REASON
+            break
+
+        messages = receive_messages(queue_url)
+        if messages is None:
+            result['StopReason'] = 'Unable to receive messages'
+            break
+        if not messages:
+            result['Drained'] = True
+            break
+
+        accounts, skipped, unparseable = get_account_messages(messages)
+        failed, left = replay_accounts(list(accounts), targets,
+                                       deployed, context)
+        replayed = list()
+        released = list()
+
+        for account_id, receipt_handles in accounts.items():
+            if account_id in failed:
+                result['Failed'] += len(receipt_handles)
+            elif account_id in left:
+                released += receipt_handles
+            else:
+                replayed += receipt_handles
+
+        not_deleted = delete_messages(queue_url, skipped + replayed)
+        release_messages(queue_url, released)
+        result['Replayed'] += len(set(replayed) - set(not_deleted))
+        result['Skipped'] += len(set(skipped) - set(not_deleted))
+        result['Failed'] += len(not_deleted)
+        result['Unparseable'] += len(unparseable)
+        result['Pending'] += len(released)
+
+        # Messages still in flight hold back the rest of their FIFO
+        # message group until the visibility timeout expires, so the
+        # next receive would look like an empty queue.
+        if unparseable:
+            result['StopReason'] = 'Unparseable messages block the queue'
+            break
+        if failed or not_deleted:
+            result['StopReason'] = 'Failed messages block the queue'
+            break
+        if left:
+            result['StopReason'] = TIMEOUT_REASON
+            break
+
+    if result['StopReason']:
+        LOGGER.warning('Stopped replay: %s', result['StopReason'])
+    LOGGER.info('Dead letter queue replay result: %s', result)
+
+    return result
+
+
+def lambda_handler(event, context):
+    '''Lambda Handler to replay life cycle events from the DLQ'''
+
+    LOGGER.info('Event: %s, Context: %s', event, context)
+
+    ss_name = os.environ['NewStackSetName']
+    param_name = os.environ['RegionsToDeploy']
+    queue_url = os.environ['DeadLetterQueueUrl']
+    regions = get_param_value(param_name)
+    targets = get_baseline_mappings(os.environ.get('BaselineStackSets', ''),
+                                    ss_name, regions)
+
+    invocation = event.get('Invocation', 1)
+    result = replay_dead_letter_queue(queue_url, targets, context)
+    result['Invocation'] = invocation
+
+    # Each invocation gets through about one batch, so keep going in a
+    # fresh invocation until the queue is drained or blocked.
+    if result['StopReason'] == TIMEOUT_REASON and context is not None:
+        if invocation < MAX_INVOCATIONS:
+            LOGGER.info('Re-invoking replay, invocation %s', invocation + 1)
+            LAMBDA.invoke(FunctionName=context.invoked_function_arn,
+                          InvocationType='Event',
+                          Payload=json.dumps({'Invocation': invocation + 1}))
+        else:
+            LOGGER.error('Stopping after %s invocations', invocation)
+
+    return result
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    lambda_handler({}, None)
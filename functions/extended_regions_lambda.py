@@ -24,11 +24,13 @@ with in AWS Control Tower
 '''
 
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait
 from time import sleep
 import os
 import boto3
 from botocore.exceptions import ClientError
 import cfnresponse
+from extended_regions_mappings import get_baseline_mappings
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -42,8 +44,14 @@ CFT = SESSION.client('cloudformation')
 ORG = SESSION.client('organizations')
 
 EXEC_ROLE = 'AWSControlTowerExecution'
-CONFIG_STACK = 'AWSControlTowerBP-BASELINE-CONFIG'
 CNFPACK_URL = 'https://marketplace-sa-resources-ct-us-east-2.s3.us-east-2.amazonaws.com/ConformsBucket.yaml'
+CAPABILITIES = ['CAPABILITY_IAM',
+                'CAPABILITY_NAMED_IAM',
+                'CAPABILITY_AUTO_EXPAND']
+MAX_WORKERS = 4
+# get_stack_operation_status polls up to 25 times, 30 sec apart
+OPERATION_WAIT = 25 * 30 + 60
+RESPONSE_MARGIN = 30
 
 
 def list_stack_sets(status='ACTIVE'):
@@ -179,19 +187,21 @@ def list_from_stack_instances(ss_name, key='Account'):
 
 
 def delete_stack_instances(ss_name, accounts, regions, retain=False):
-    '''Delete all stack instances with in the stackset'''
+    '''Delete stack instances with in the stackset, return operation id'''
 
-    result = False
+    result = None
     ops = {
         'MaxConcurrentPercentage': 100,
         'FailureTolerancePercentage': 50
         }
 
     try:
-        CFT.delete_stack_instances(StackSetName=ss_name, Accounts=accounts,
-                                   Regions=regions, RetainStacks=retain,
-                                   OperationPreferences=ops)
-        result = True
+        result = CFT.delete_stack_instances(StackSetName=ss_name,
+                                            Accounts=accounts,
+                                            Regions=regions,
+                                            RetainStacks=retain,
+                                            OperationPreferences=ops
+                                            )['OperationId']
     except Exception as exe:
         LOGGER.error('Unable to delete stackset: %s', str(exe))
 
@@ -236,6 +246,10 @@ def delete_stackset(ss_name):
     ss_regions = list()
     delete_status = False
 
+    if ss_name not in list_stack_sets():
+        LOGGER.warning('StackSet %s not found, nothing to delete', ss_name)
+        return True
+
     ss_list = list_all_stack_instances(ss_name)
 
     if len(ss_list) > 0:
@@ -307,14 +321,10 @@ def get_org_id():
 
 
 def launch_stackset(ss_name, template, params,
-                    admin_role_arn, template_type='body'):
+                    admin_role_arn, description, template_type='body'):
     ''' Launch Config Stackset on the Master Account '''
 
     result = True
-    capabilities = ['CAPABILITY_IAM',
-                    'CAPABILITY_NAMED_IAM',
-                    'CAPABILITY_AUTO_EXPAND']
-    description = 'Enable Config in additional regions'
     active_stack_sets = list_stack_sets()
 
     if ss_name not in active_stack_sets:
@@ -326,14 +336,14 @@ def launch_stackset(ss_name, template, params,
                                      TemplateBody=template, Parameters=params,
                                      AdministrationRoleARN=admin_role_arn,
                                      ExecutionRoleName=EXEC_ROLE,
-                                     Capabilities=capabilities)
+                                     Capabilities=CAPABILITIES)
             else:
                 CFT.create_stack_set(StackSetName=ss_name,
                                      Description=description,
                                      TemplateURL=template, Parameters=params,
                                      AdministrationRoleARN=admin_role_arn,
                                      ExecutionRoleName=EXEC_ROLE,
-                                     Capabilities=capabilities)
+                                     Capabilities=CAPABILITIES)
         except ClientError as exe:
             if exe.response['Error']['Code'] == 'NameAlreadyExistsException':
                 LOGGER.error("StackSet already exists: %s", str(exe))
@@ -346,23 +356,76 @@ def launch_stackset(ss_name, template, params,
     return result
 
 
-def deploy_config_stackset(ss_name, admin_role_arn, regions, deploy_to):
-    '''Deploy config stackset'''
+def merge_stackset_parameters(params, overrides):
+    '''Return stackset parameters with the given values overridden,
+    None if an override does not match a stackset parameter'''
 
-    config_result = False
+    result = list()
+    keys = [item['ParameterKey'] for item in params]
+    unknown = [key for key in overrides if key not in keys]
+
+    if unknown:
+        LOGGER.error('Unknown parameters %s, expected one of %s',
+                     unknown, keys)
+        return None
+
+    for item in params:
+        key = item['ParameterKey']
+        value = overrides.get(key, item['ParameterValue'])
+        result.append({'ParameterKey': key, 'ParameterValue': value})
+
+    return result
+
+
+def update_stackset_parameters(ss_name, params, admin_role_arn):
+    '''Update stackset parameters on all instances, return operation id'''
+
+    result = None
+    ops = {
+        'MaxConcurrentPercentage': 100,
+        'FailureTolerancePercentage': 50
+        }
+
+    try:
+        LOGGER.info('Update Stack Set parameters: %s, %s', ss_name, params)
+        result = CFT.update_stack_set(StackSetName=ss_name,
+                                      UsePreviousTemplate=True,
+                                      Parameters=params,
+                                      AdministrationRoleARN=admin_role_arn,
+                                      ExecutionRoleName=EXEC_ROLE,
+                                      Capabilities=CAPABILITIES,
+                                      OperationPreferences=ops
+                                      )['OperationId']
+    except ClientError as exe:
+        LOGGER.error("Unexpected error: %s", str(exe))
+
+    return result
+
+
+def deploy_baseline_stackset(src_name, ss_name, admin_role_arn,
+                             regions, deploy_to, overrides=None):
+    '''Clone the source stackset and deploy it to the given regions'''
+
+    baseline_result = False
     stack_status = False
     result = False
 
-    all_accounts = list_from_stack_instances(CONFIG_STACK, key='Account')
+    all_accounts = list_from_stack_instances(src_name, key='Account')
     LOGGER.info('List of AWS Accounts: %s', all_accounts)
 
-    if CONFIG_STACK in list_stack_sets():
-        config_body = get_stackset_body(CONFIG_STACK)
-        config_params = get_stackset_parameters(CONFIG_STACK)
-        LOGGER.info('Config ParamList: %s', config_params)
-        config_result = launch_stackset(ss_name, config_body,
-                                        config_params, admin_role_arn)
-        LOGGER.info('Config Stackset: %s', config_result)
+    if src_name in list_stack_sets():
+        baseline_body = get_stackset_body(src_name)
+        baseline_params = merge_stackset_parameters(
+            get_stackset_parameters(src_name) or list(), overrides or dict())
+        if baseline_params is None:
+            LOGGER.error('Invalid parameter overrides for %s', ss_name)
+            return result
+        LOGGER.info('%s ParamList: %s', src_name, baseline_params)
+        description = 'Extend ' + src_name + ' to additional regions'
+        baseline_result = launch_stackset(ss_name, baseline_body,
+                                          baseline_params, admin_role_arn,
+                                          description)
+        LOGGER.info('Baseline Stackset %s: %s', ss_name, baseline_result)
         if deploy_to != 'Future Only':
             LOGGER.info('Deploy To setting: %s', deploy_to)
             operation_id = add_stack_instance(ss_name, all_accounts,
@@ -375,14 +438,165 @@ def deploy_config_stackset(ss_name, admin_role_arn, regions, deploy_to):
             stack_status = True
     else:
         LOGGER.error('StackSet %s not found: %s',
-                     CONFIG_STACK, list_stack_sets())
+                     src_name, list_stack_sets())
 
-    if config_result and stack_status:
+    if baseline_result and stack_status:
         result = True
 
     return result
 
 
+def update_baseline_stackset(old_item, new_item, admin_role_arn):
+    '''Apply parameter and region changes of a mapping to its stackset'''
+
+    ss_name = new_item['Target']
+    result = True
+
+    if old_item['Source'] != new_item['Source']:
+        LOGGER.error('Source of %s cannot change from %s to %s, '
+                     'use a new Target instead', ss_name,
+                     old_item['Source'], new_item['Source'])
+        return False
+
+    if old_item['Parameters'] != new_item['Parameters']:
+        params = merge_stackset_parameters(
+            get_stackset_parameters(new_item['Source']) or list(),
+            new_item['Parameters'])
+        if params is None:
+            LOGGER.error('Invalid parameter overrides for %s', ss_name)
+            return False
+        operation_id = update_stackset_parameters(ss_name, params,
+                                                  admin_role_arn)
+        result = get_stack_operation_status(ss_name, operation_id)
+
+    added = [item for item in new_item['Regions']
+             if item not in old_item['Regions']]
+    removed = [item for item in old_item['Regions']
+               if item not in new_item['Regions']]
+    accounts = list()
+    if added or removed:
+        accounts = list_from_stack_instances(ss_name, key='Account')
+
+    if result and added and accounts:
+        LOGGER.info('Adding regions %s to %s', added, ss_name)
+        operation_id = add_stack_instance(ss_name, accounts, added)
+        result = get_stack_operation_status(ss_name, operation_id)
+
+    if result and removed and accounts:
+        LOGGER.info('Removing regions %s from %s', removed, ss_name)
+        operation_id = delete_stack_instances(ss_name, accounts, removed)
+        result = get_stack_operation_status(ss_name, operation_id)
+
+    return result
+
+
+def get_remaining_seconds(context):
+    '''Return seconds left to send the custom resource response'''
+
+    if context is None:
+        return None
+
+    return max(context.get_remaining_time_in_millis() / 1000 -
+               RESPONSE_MARGIN, 0)
+
+
+def has_time_for_operation(context):
+    '''Return True if a stackset operation can finish before timeout'''
+
+    remaining = get_remaining_seconds(context)
+
+    return remaining is None or remaining >= OPERATION_WAIT
+
+
+def run_baselines(calls, max_workers=MAX_WORKERS, context=None):
+    '''Run the calls per target concurrently, return status per target
+
+    Calls that have not finished when the custom resource must respond
+    are reported as failed.
+    '''
+
+    result = dict()
+    futures = dict()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    for target, (func, args) in calls.items():
+        futures[target] = executor.submit(func, *args)
+
+    done = wait(futures.values(), timeout=get_remaining_seconds(context))[0]
+
+    for target, future in futures.items():
+        result[target] = False
+        if future not in done:
+            future.cancel()
+            LOGGER.error('Baseline %s did not finish in time', target)
+            continue
+        try:
+            result[target] = future.result()
+        except Exception as exe:
+            LOGGER.error('Baseline %s failed: %s', target, str(exe))
+
+    executor.shutdown(wait=False)
+    LOGGER.info('Baseline StackSet results: %s', result)
+
+    return result
+
+
+def deploy_baseline_stacksets(mappings, admin_role_arn, deploy_to,
+                              max_workers=MAX_WORKERS, context=None):
+    '''Deploy all baseline stacksets concurrently, return status per target'''
+
+    calls = dict()
+
+    for item in mappings:
+        calls[item['Target']] = (deploy_baseline_stackset,
+                                 (item['Source'], item['Target'],
+                                  admin_role_arn, item['Regions'],
+                                  deploy_to, item['Parameters']))
+
+    return run_baselines(calls, max_workers, context)
+
+
+def update_baseline_stacksets(old_mappings, mappings, admin_role_arn,
+                              deploy_to, max_workers=MAX_WORKERS,
+                              context=None):
+    '''Deploy added, update changed and delete removed baseline stacksets'''
+
+    calls = dict()
+    old_items = dict((item['Target'], item) for item in old_mappings)
+    new_targets = [item['Target'] for item in mappings]
+
+    for item in mappings:
+        old_item = old_items.get(item['Target'])
+        if old_item is None:
+            calls[item['Target']] = (deploy_baseline_stackset,
+                                     (item['Source'], item['Target'],
+                                      admin_role_arn, item['Regions'],
+                                      deploy_to, item['Parameters']))
+        elif old_item != item:
+            calls[item['Target']] = (update_baseline_stackset,
+                                     (old_item, item, admin_role_arn))
+
+    for target in old_items:
+        if target not in new_targets:
+            calls[target] = (delete_stackset, (target,))
+
+    LOGGER.info('Baseline StackSet changes: %s', list(calls))
+
+    return run_baselines(calls, max_workers, context)
+
+
+def delete_baseline_stacksets(mappings, max_workers=MAX_WORKERS,
+                              context=None):
+    '''Delete all baseline stacksets concurrently, return status per target'''
+
+    calls = dict()
+
+    for item in mappings:
+        calls[item['Target']] = (delete_stackset, (item['Target'],))
+
+    return run_baselines(calls, max_workers, context)
+
+
 def deploy_cnfpack_stackset(ss_name, admin_role_arn,
                             sse_algorithm, kms_key, log_account_id):
     '''Deploy config stackset'''
@@ -403,8 +617,10 @@ def deploy_cnfpack_stackset(ss_name, admin_role_arn,
     key_dict['ParameterValue'] = kms_key
     cnf_params.append(key_dict)
 
+    description = 'Configure S3 bucket for Config Conformance Packs'
     result = launch_stackset(ss_name, CNFPACK_URL, cnf_params,
-                             admin_role_arn, template_type='URL')
+                             admin_role_arn, description,
+                             template_type='URL')
     LOGGER.info('Conformance Stack Set Status: %s', result)
 
     if result:
@@ -425,29 +641,52 @@ def lambda_handler(event, context):
     LOGGER.info('EVENT Received: %s', event)
     admin_role_arn = 'arn:aws:iam::' + get_master_id() + \
                      ':role/service-role/AWSControlTowerStackSetRole'
+    properties = event.get('ResourceProperties', {})
+    old_properties = event.get('OldResourceProperties', {})
     deploy_to = os.environ['DeployTo']
-    regions = os.environ['RegionsToDeploy'].split(',')
+    regions = properties.get('RegionsToDeploy',
+                             os.environ['RegionsToDeploy'])
+    old_regions = old_properties.get('RegionsToDeploy', regions)
     sse_algorithm = os.environ['SSEAlgorithm']
     kms_key = os.environ['KMSMasterKeyID']
     set_cnfpack = os.environ['SetupConformancePackEnv'].upper()
     log_account_id = os.environ['LogArchiveAccountId']
     custom_stack = os.environ['NewStackSetName']
+    max_workers = int(os.environ.get('MaxConcurrentBaselines', MAX_WORKERS))
 
     cnfpack_stack = 'CNFPACK-LOGARCHIVE-' + custom_stack
+    baseline_results = dict()
     config_result = False
     cnfpack_result = False
     response_data = {}
     status = False
 
-    if event['RequestType'] == 'Create':
-        config_result = deploy_config_stackset(custom_stack, admin_role_arn,
-                                               regions, deploy_to)
-        if config_result and set_cnfpack == 'YES':
-            cnfpack_result = deploy_cnfpack_stackset(cnfpack_stack,
+    try:
+        mappings = get_baseline_mappings(
+            properties.get('BaselineStackSets', ''), custom_stack, regions)
+    except ValueError as exe:
+        LOGGER.error('Invalid BaselineStackSets: %s', str(exe))
+        mappings = None
+
+    if mappings is None and event['RequestType'] != 'Delete':
+        LOGGER.error('Unable to %s with invalid mappings',
+                     event['RequestType'])
+
+    elif event['RequestType'] == 'Create':
+        baseline_results = deploy_baseline_stacksets(mappings,
                                                      admin_role_arn,
-                                                     sse_algorithm,
-                                                     kms_key,
-                                                     log_account_id)
+                                                     deploy_to, max_workers,
+                                                     context)
+        config_result = all(baseline_results.values())
+        if config_result and set_cnfpack == 'YES':
+            if has_time_for_operation(context):
+                cnfpack_result = deploy_cnfpack_stackset(cnfpack_stack,
+                                                         admin_role_arn,
+                                                         sse_algorithm,
+                                                         kms_key,
+                                                         log_account_id)
+            else:
+                LOGGER.error('Not enough time left to deploy CnfPack')
         else:
             LOGGER.info('SKIPPING CnfPack: %s, %s', config_result, set_cnfpack)
             cnfpack_result = True
@@ -456,15 +695,38 @@ def lambda_handler(event, context):
             status = True
 
     elif event['RequestType'] == 'Update':
-        status = True
+        try:
+            old_mappings = get_baseline_mappings(
+                old_properties.get('BaselineStackSets', ''),
+                custom_stack, old_regions)
+        except ValueError as exe:
+            LOGGER.warning('Ignoring invalid old mappings: %s', str(exe))
+            old_mappings = list()
+
+        baseline_results = update_baseline_stacksets(old_mappings, mappings,
+                                                     admin_role_arn,
+                                                     deploy_to, max_workers,
+                                                     context)
+        status = all(baseline_results.values())
 
     elif event['RequestType'] == 'Delete':
-        config_result = delete_stackset(custom_stack)
-        cnfpack_result = delete_stackset(cnfpack_stack)
+        # A Create that failed on invalid mappings created no baselines
+        if mappings is None:
+            mappings = list()
+        baseline_results = delete_baseline_stacksets(mappings, max_workers,
+                                                     context)
+        config_result = all(baseline_results.values())
+        if has_time_for_operation(context):
+            cnfpack_result = delete_stackset(cnfpack_stack)
+        else:
+            LOGGER.error('Not enough time left to delete CnfPack')
 
         if config_result and cnfpack_result:
             status = True
 
+    for target, target_status in baseline_results.items():
+        response_data[target] = SUCCESS if target_status else FAILED
+
     if status:
         cfnresponse.send(event, context, cfnresponse.SUCCESS,
                          response_data, "CustomResourcePhysicalID")
@@ -28,11 +28,13 @@ from time import sleep
 import os
 import boto3
 from botocore.exceptions import ClientError
+from extended_regions_mappings import get_baseline_mappings
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
-CFT = boto3.client('cloudformation')
-SSM = boto3.client('ssm')
+ENDPOINT_URL = os.environ.get('EndpointUrl') or None
+CFT = boto3.client('cloudformation', endpoint_url=ENDPOINT_URL)
+SSM = boto3.client('ssm', endpoint_url=ENDPOINT_URL)
 
 
 def list_parameters():
@@ -151,30 +153,48 @@ def get_stack_operation_status(ss_name, operation_id):
     return count > 0
 
 
-def lambda_handler(event, context):
-    '''Lambda Handler to process life cycle event'''
-
-    LOGGER.info('Event: %s, Context: %s', event, context)
+def get_new_account_id(message_body):
+    '''Return account id from a successful CreateManagedAccount event'''
 
-    ss_name = os.environ['NewStackSetName']
-    param_name = os.environ['RegionsToDeploy']
-    regions = get_param_value(param_name)
-    event_info = json.loads(event['Records'][0]['body'])
+    result = None
+    event_info = json.loads(message_body)
     event_details = event_info['detail']
     event_name = event_details['eventName']
     srv_event_details = event_details['serviceEventDetails']
-    response_data = {}
 
     if event_name == 'CreateManagedAccount':
         new_account_info = srv_event_details['createManagedAccountStatus']
         cmd_status = new_account_info['state']
         if cmd_status == 'SUCCEEDED':
-            LOGGER.info('Sucessful event recieved: %s', event)
-            account_id = new_account_info['account']['accountId']
-            operation_id = add_stack_instance(ss_name, [account_id], regions)
-            response_data['Result'] = cmd_status
-            get_stack_operation_status(ss_name, operation_id)
+            LOGGER.info('Sucessful event recieved: %s', event_info)
+            result = new_account_info['account']['accountId']
         else:
-            LOGGER.info('Unsucessful event recieved. SKIPPING: %s', event)
+            LOGGER.info('Unsucessful event recieved. SKIPPING: %s',
+                        event_info)
     else:
-        LOGGER.info('Unexpected life cycle event captured: %s', event)
+        LOGGER.info('Unexpected life cycle event captured: %s', event_info)
+
+    return result
+
+
+def lambda_handler(event, context):
+    '''Lambda Handler to process life cycle event'''
+
+    LOGGER.info('Event: %s, Context: %s', event, context)
+
+    ss_name = os.environ['NewStackSetName']
+    param_name = os.environ['RegionsToDeploy']
+    regions = get_param_value(param_name)
+    targets = get_baseline_mappings(os.environ.get('BaselineStackSets', ''),
+                                    ss_name, regions)
+    account_id = get_new_account_id(event['Records'][0]['body'])
+    response_data = {}
+
+    if account_id:
+        operations = dict()
+        for item in targets:
+            operations[item['Target']] = add_stack_instance(
+                item['Target'], [account_id], item['Regions'])
+        response_data['Result'] = 'SUCCEEDED'
+        for target, operation_id in operations.items():
+            get_stack_operation_status(target, operation_id)
@@ -0,0 +1,87 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Baseline StackSet mappings shared by the extended region lambdas
+'''
+
+import json
+
+CONFIG_STACK = 'AWSControlTowerBP-BASELINE-CONFIG'
+
+
+def get_regions(regions):
+    '''Return list of regions from a comma separated string or a list
+
+    Raises ValueError if no region is given.
+    '''
+
+    if isinstance(regions, str):
+        regions = regions.split(',')
+
+    if not isinstance(regions, list) or \
+            not all(isinstance(item, str) for item in regions):
+        raise ValueError('Invalid regions: %s' % regions)
+
+    result = [item.strip() for item in regions if item.strip()]
+
+    if not result:
+        raise ValueError('No regions given: %s' % regions)
+
+    return result
+
+
+def get_baseline_mappings(mappings, ss_name, regions):
+    '''Return list of source to target StackSet mappings to deploy
+
+    Raises ValueError if the mappings are not a non-empty JSON list of
+    Source/Target objects, if a Target is listed more than once or if a
+    mapping has no regions.
+    '''
+
+    result = list()
+    targets = list()
+
+    if not mappings or not mappings.strip():
+        return [{'Source': CONFIG_STACK, 'Target': ss_name,
+                 'Regions': get_regions(regions), 'Parameters': {}}]
+
+    mappings = json.loads(mappings)
+
+    if not isinstance(mappings, list) or not mappings:
+        raise ValueError('BaselineStackSets must be a non-empty JSON list')
+
+    for item in mappings:
+        if not isinstance(item, dict) or \
+                not isinstance(item.get('Source'), str) or \
+                not isinstance(item.get('Target'), str):
+            raise ValueError('Invalid baseline mapping: %s' % item)
+        if item['Target'] in targets:
+            raise ValueError('Duplicate baseline target: %s' % item['Target'])
+        item_params = item.get('Parameters', {})
+        if not isinstance(item_params, dict):
+            raise ValueError('Invalid parameters in mapping: %s' % item)
+        targets.append(item['Target'])
+        result.append({'Source': item['Source'],
+                       'Target': item['Target'],
+                       'Regions': get_regions(item.get('Regions', regions)),
+                       'Parameters': item_params})
+
+    return result
@@ -0,0 +1,251 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+
+'''
+Replay the lifecycle event dead letter queue against moto SQS and
+CloudFormation stand-ins
+'''
+
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'functions'))
+
+import boto3  # noqa: E402
+from moto import mock_aws  # noqa: E402
+
+import extended_regions_dlq_replay as replay  # noqa: E402
+
+TARGET = 'CUSTOM-CONFIG-STACKSET'
+REGIONS = ['us-west-1', 'us-west-2']
+TEMPLATE = json.dumps({'Resources': {'Handle': {
+    'Type': 'AWS::CloudFormation::WaitConditionHandle'}}})
+
+
+def lifecycle_event(account_id, state='SUCCEEDED', event_id='1'):
+    '''Return a CreateManagedAccount event body as EventBridge sends it'''
+
+    return json.dumps({'id': event_id, 'detail': {
+        'eventName': 'CreateManagedAccount',
+        'serviceEventDetails': {'createManagedAccountStatus': {
+            'state': state,
+            'account': {'accountId': account_id}}}}})
+
+
+class ReplayTest(unittest.TestCase):
+    '''Dead letter queue replay'''
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.addCleanup(self.mock.stop)
+        self.sqs = boto3.client('sqs')
+        self.cft = boto3.client('cloudformation')
+        self.queue_url = self.sqs.create_queue(
+            QueueName='dlq.fifo',
+            Attributes={'FifoQueue': 'true',
+                        'ContentBasedDeduplication': 'true'})['QueueUrl']
+        self.cft.create_stack_set(StackSetName=TARGET, TemplateBody=TEMPLATE)
+        self.targets = [{'Target': TARGET, 'Regions': REGIONS}]
+
+    def send(self, *bodies):
+        for body in bodies:
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body,
+                                  MessageGroupId='ExtendedRegion')
+
+    def deploy(self, accounts, regions):
+        self.cft.create_stack_instances(StackSetName=TARGET,
+                                        Accounts=accounts, Regions=regions)
+
+    def deployed(self):
+        summaries = self.cft.list_stack_instances(
+            StackSetName=TARGET)['Summaries']
+        return sorted((item['Account'], item['Region'])
+                      for item in summaries)
+
+    def queue_counts(self):
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url, AttributeNames=['All'])['Attributes']
+        return (int(attributes['ApproximateNumberOfMessages']),
+                int(attributes['ApproximateNumberOfMessagesNotVisible']))
+
+    def test_replay_deploys_missing_accounts(self):
+        self.deploy(['111111111111'], REGIONS)
+        self.deploy(['222222222222'], ['us-west-1'])
+        self.send(lifecycle_event('111111111111'),
+                  lifecycle_event('222222222222'),
+                  lifecycle_event('333333333333'),
+                  lifecycle_event('333333333333', event_id='2'),
+                  lifecycle_event('444444444444', state='FAILED'))
+
+        with mock.patch.object(replay, 'add_stack_instance',
+                               wraps=replay.add_stack_instance) as add:
+            result = replay.replay_dead_letter_queue(self.queue_url,
+                                                     self.targets)
+
+        self.assertTrue(result['Drained'])
+        self.assertEqual(result['Replayed'], 4)
+        self.assertEqual(result['Skipped'], 1)
+        self.assertEqual(result['Failed'], 0)
+        self.assertEqual(self.queue_counts(), (0, 0))
+        self.assertEqual(sorted(call[0][1:] for call in add.call_args_list),
+                         [(['222222222222'], ['us-west-2']),
+                          (['333333333333'], REGIONS)])
+        self.assertEqual(self.deployed(),
+                         [(account, region) for account in
+                          ['111111111111', '222222222222', '333333333333']
+                          for region in REGIONS])
+
+    def test_replay_drains_across_batches(self):
+        accounts = ['%012d' % number for number in range(1, 24)]
+        self.send(*[lifecycle_event(account) for account in accounts])
+
+        result = replay.replay_dead_letter_queue(self.queue_url,
+                                                 self.targets)
+
+        self.assertTrue(result['Drained'])
+        self.assertEqual(result['Replayed'], len(accounts))
+        self.assertEqual(len(self.deployed()), len(accounts) * len(REGIONS))
+
+    def test_failed_operation_keeps_message(self):
+        self.send(lifecycle_event('111111111111'))
+
+        with mock.patch.object(replay, 'get_stack_operation_status',
+                               return_value=False):
+            result = replay.replay_dead_letter_queue(self.queue_url,
+                                                     self.targets)
+
+        self.assertFalse(result['Drained'])
+        self.assertEqual(result['Failed'], 1)
+        self.assertEqual(result['Replayed'], 0)
+        self.assertEqual(self.queue_counts(), (0, 1))
+
+    def test_failed_delete_is_not_replayed(self):
+        self.send(lifecycle_event('111111111111'))
+
+        with mock.patch.object(replay, 'delete_messages',
+                               side_effect=lambda url, handles: handles):
+            result = replay.replay_dead_letter_queue(self.queue_url,
+                                                     self.targets)
+
+        self.assertEqual(result['Replayed'], 0)
+        self.assertEqual(result['Failed'], 1)
+        self.assertEqual(result['StopReason'],
+                         'Failed messages block the queue')
+
+    def test_unparseable_message_stops_replay(self):
+        self.send(lifecycle_event('111111111111'),
+                  json.dumps({'detail': None}))
+
+        result = replay.replay_dead_letter_queue(self.queue_url,
+                                                 self.targets)
+
+        self.assertFalse(result['Drained'])
+        self.assertEqual(result['Replayed'], 1)
+        self.assertEqual(result['Unparseable'], 1)
+        self.assertEqual(result['StopReason'],
+                         'Unparseable messages block the queue')
+        self.assertEqual(self.queue_counts(), (0, 1))
+
+    def test_timeout_releases_pending_messages(self):
+        self.deploy(['222222222222'], ['us-west-1'])
+        self.send(lifecycle_event('111111111111'),
+                  lifecycle_event('222222222222'))
+        context = mock.Mock()
+        # Enough time for the first batch and round, none for the second
+        context.get_remaining_time_in_millis.side_effect = [
+            900000, 900000, 0]
+
+        result = replay.replay_dead_letter_queue(self.queue_url,
+                                                 self.targets, context)
+
+        self.assertEqual(result['StopReason'], replay.TIMEOUT_REASON)
+        self.assertEqual(result['Replayed'], 1)
+        self.assertEqual(result['Pending'], 1)
+        self.assertEqual(self.queue_counts(), (1, 0))
+
+    def test_receive_error_is_not_drained(self):
+        result = replay.replay_dead_letter_queue(self.queue_url + '-missing',
+                                                 self.targets)
+
+        self.assertFalse(result['Drained'])
+        self.assertEqual(result['StopReason'], 'Unable to receive messages')
+
+    def test_list_error_stops_replay(self):
+        self.send(lifecycle_event('111111111111'))
+
+        result = replay.replay_dead_letter_queue(
+            self.queue_url, [{'Target': 'MISSING', 'Regions': REGIONS}])
+
+        self.assertFalse(result['Drained'])
+        self.assertEqual(result['StopReason'],
+                         'Unable to list stack instances of MISSING')
+        self.assertEqual(self.queue_counts(), (1, 0))
+
+    def test_handler_reinvokes_on_timeout(self):
+        timed_out = {'StopReason': replay.TIMEOUT_REASON}
+        context = mock.Mock(invoked_function_arn='arn:replay')
+        env = {'NewStackSetName': TARGET, 'RegionsToDeploy': 'regions',
+               'DeadLetterQueueUrl': self.queue_url}
+
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(replay, 'get_param_value',
+                                  return_value=REGIONS), \
+                mock.patch.object(replay, 'replay_dead_letter_queue',
+                                  return_value=timed_out), \
+                mock.patch.object(replay, 'LAMBDA') as lambda_client:
+            result = replay.lambda_handler({'Invocation': 2}, context)
+
+        self.assertEqual(result['Invocation'], 2)
+        lambda_client.invoke.assert_called_once_with(
+            FunctionName='arn:replay', InvocationType='Event',
+            Payload=json.dumps({'Invocation': 3}))
+
+
+class GroupMissingRegionsTest(unittest.TestCase):
+    '''Split accounts into create and update operations'''
+
+    def test_only_current_instances_are_deployed(self):
+        deployed = {
+            '111111111111': {'us-west-1': 'CURRENT',
+                             'us-west-2': 'CURRENT'},
+            '222222222222': {'us-west-1': 'OUTDATED'},
+            '333333333333': {'us-west-1': 'INOPERABLE',
+                             'us-west-2': 'OUTDATED'}}
+
+        result = replay.group_missing_regions(
+            ['111111111111', '222222222222', '333333333333',
+             '444444444444'], REGIONS, deployed)
+
+        self.assertEqual(result, {
+            ('create', ('us-west-2',)): ['222222222222'],
+            ('update', ('us-west-1',)): ['222222222222'],
+            ('update', tuple(REGIONS)): ['333333333333'],
+            ('create', tuple(REGIONS)): ['444444444444']})
+
+
+if __name__ == '__main__':
+    unittest.main()